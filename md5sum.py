@@ -1,16 +1,29 @@
 #!/usr/bin/env python
 """Serve as a convenient md5sum command on windows."""
-import argparse
 import codecs
+import concurrent.futures
 import glob
 import hashlib
+import io
+import mmap
 import os
+import queue
+import re
+import stat
 import sys
+import threading
 
-CHUNK_SIZE = 4096  # Process 4kb at a time
+CHUNK_SIZE = 1 << 20  # Process 1mb at a time
+MAX_WORKERS = min(8, os.cpu_count() or 1)  # Threads hashing files at once
+MMAP_SIZE = 16 << 20  # Map or read ahead files larger than 16mb
+READ_AHEAD = 4  # Chunks read in advance when a large file can't be mapped
 INVALID_FILES = {'.', '..'}  # Ignore these
-HASH_CHARS = {'a', 'b', 'c', 'd', 'e', 'f',
-              '0', '1', '2', '3', '4', '5', '6', '7', '8', '9'}
+HASH_LENGTHS = {'md5': 32, 'blake3': 64, 'xxh128': 32}  # Hex digest sizes
+HASH_RE = {algo: re.compile('[0-9a-fA-F]{%d}' % n)  # Valid hash
+           for algo, n in HASH_LENGTHS.items()}
+LINE_RE = {algo: re.compile(r'\s*([0-9a-fA-F]{%d}) [ *](.*\S)\s*' % n)
+           for algo, n in HASH_LENGTHS.items()}  # <hash>  <file>
+GLOB_RE = re.compile('[*?[]')  # Wildcards that need glob expansion
 
 
 def eprint(*args, **kwargs):
@@ -18,58 +31,241 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def get_encoding(file_path):
+def get_encoding(f):
     """
-    Determine the BOM for the file.
+    Determine the BOM for the file without consuming it.
 
-    @param file_path: the text file in question
+    @param f: the text file in question, opened as a buffered binary file
     @return string for the utf encoding of the file,
         or None if no BOM was found
     """
-    with open(file_path, 'rb') as f:
-        bom = f.read(4)
-
-        # Order matters to avoid confusing utf32-le for utf16-le
-        if bom == codecs.BOM_UTF32_BE:
-            return 'utf-32-be'
-        if bom == codecs.BOM_UTF32_LE:
-            return 'utf-32-le'
-        if bom[:3] == codecs.BOM_UTF8:
-            return 'utf-8'
-        if bom[:2] == codecs.BOM_UTF16_LE:
-            return 'utf-16-le'
-        if bom[:2] == codecs.BOM_UTF16_BE:
-            return 'utf-16-be'
-        return None
+    bom = f.peek(4)[:4]
+
+    # Order matters to avoid confusing utf32-le for utf16-le
+    if bom == codecs.BOM_UTF32_BE:
+        return 'utf-32-be'
+    if bom == codecs.BOM_UTF32_LE:
+        return 'utf-32-le'
+    if bom[:3] == codecs.BOM_UTF8:
+        return 'utf-8'
+    if bom[:2] == codecs.BOM_UTF16_LE:
+        return 'utf-16-le'
+    if bom[:2] == codecs.BOM_UTF16_BE:
+        return 'utf-16-be'
+    return None
+
+
+def read_chunks(f, buffer):
+    """
+    Read a file in chunks, reusing the same buffer for every chunk.
+
+    @param f: file object opened in binary mode
+    @param buffer: bytearray to read into, of CHUNK_SIZE bytes
+    @return generator of memoryviews into buffer, each only valid until
+        the next chunk is read
+    """
+    view = memoryview(buffer)
+    n = f.readinto(buffer)
+    while n:
+        yield view[:n]
+        n = f.readinto(buffer)
+
+
+def read_ahead(f):
+    """
+    Read chunks of a file on a background thread.
+
+    Up to READ_AHEAD chunks are read while the caller is still working
+    on earlier ones, so disk reads overlap with hashing.
+
+    @param f: file object opened in binary mode
+    @return generator of memoryviews of at most CHUNK_SIZE bytes, each
+        only valid until the next chunk is requested
+    """
+    chunks = queue.Queue(READ_AHEAD)
+    stop = threading.Event()
+    error = []
+
+    # Enough buffers for every queued chunk, plus the one being read and
+    # the one the caller is still hashing
+    buffers = [bytearray(CHUNK_SIZE) for _ in range(READ_AHEAD + 2)]
+
+    def reader():
+        try:
+            i = 0
+            n = f.readinto(buffers[i])
+            while n and not stop.is_set():
+                chunks.put(memoryview(buffers[i])[:n])
+                i = (i + 1) % len(buffers)
+                n = f.readinto(buffers[i])
+        except BaseException as e:
+            error.append(e)  # Raised by the caller instead of ending early
+        finally:
+            chunks.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    finished = False
+    try:
+        for chunk in iter(chunks.get, None):
+            yield chunk
+        finished = True
+    finally:
+        # If the caller stopped early, unblock the reader so it can exit
+        if not finished:
+            stop.set()
+            while chunks.get() is not None:
+                pass
+        thread.join()
+    if error:
+        raise error[0]
+
+
+def new_hash(algo='md5'):
+    """
+    Create a hash object for the given algorithm.
+
+    blake3 and xxh128 are much faster than md5 and need the blake3 and
+    xxhash packages. xxh128 is not cryptographic, so it only catches
+    accidental corruption.
+
+    @param algo: one of the keys of HASH_LENGTHS
+    @return hash object with update and hexdigest methods
+    @raise ImportError if the package for the algorithm is not installed
+    """
+    if algo == 'blake3':
+        import blake3
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    if algo == 'xxh128':
+        import xxhash
+        return xxhash.xxh3_128()
+    return hashlib.md5()
+
+
+def hash_mmap(f, algo='md5'):
+    """
+    Hash a whole file in one call through a memory map.
+
+    @param f: file object opened in binary mode
+    @param algo: hash algorithm to use instead of md5, see new_hash
+    @return string of the hex digest
+    @raise OSError or ValueError if the file can't be memory mapped
+    """
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        hasher = new_hash(algo)
+        hasher.update(mm)
+        return hasher.hexdigest()
+
 
+def hash_file(f, size, algo='md5'):
+    """
+    Hash an open file, picking the fastest way to read it for its size.
 
-def calculate_md5sum(file_path):
+    @param f: file object opened in binary mode without buffering
+    @param size: size of the file in bytes, or None for pipes and devices
+        whose size isn't known up front
+    @param algo: hash algorithm to use instead of md5, see new_hash
+    @return string of the hex digest
+    """
+    # Hash small files with a single read
+    if size is not None and size < CHUNK_SIZE:
+        hasher = new_hash(algo)
+        hasher.update(f.read())
+        return hasher.hexdigest()
+
+    if size is not None and size > MMAP_SIZE:
+        # Hash large files straight out of the page cache in one
+        # call, where the address space allows it
+        if sys.maxsize > 2**32:
+            try:
+                return hash_mmap(f, algo)
+            except (OSError, ValueError):
+                pass  # Not mappable, so stream it instead
+
+        # Otherwise overlap reads with hashing, which is only worth
+        # a thread for files this large
+        chunks = read_ahead(f)
+
+    # Let hashlib run the read loop in C (python 3.11+)
+    elif hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, lambda: new_hash(algo)).hexdigest()
+    else:
+        chunks = read_chunks(f, bytearray(CHUNK_SIZE))
+
+    hasher = new_hash(algo)
+    for chunk in chunks:
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def calculate_hash(file_path, algo='md5', seen=None):
     """
-    Calculate the md5sum for the given file.
+    Calculate the hash of the given file, md5 unless algo says otherwise.
 
     @param file_path: path to the file
-    @return string of the md5sum, or None if unsuccessful
+    @param algo: hash algorithm to use instead of md5, see new_hash
+    @param seen: optional dict shared by calls hashing a batch of files,
+        so that paths to the same file, such as duplicate arguments or
+        hard links, are only read once
+    @return string of the hex digest, or None if unsuccessful
     """
-    md5 = hashlib.md5()
     try:
-        with open(file_path, 'rb') as file_path:
-            chunk = file_path.read(CHUNK_SIZE)
-            while chunk:
-                md5.update(chunk)
-                chunk = file_path.read(CHUNK_SIZE)
+        with open(file_path, 'rb', buffering=0) as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size if stat.S_ISREG(st.st_mode) else None
+            # Only regular files with ids can be matched up, pipes and
+            # devices can give different data through each path
+            if seen is None or size is None or st.st_ino == 0:
+                return hash_file(f, size, algo)
+
+            # The first call for a file hashes it, any others wait for it
+            key = (st.st_dev, st.st_ino, st.st_size)
+            future = concurrent.futures.Future()
+            first = seen.setdefault(key, future)
+            if first is not future:
+                return first.result()
+            try:
+                future.set_result(hash_file(f, size, algo))
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            return future.result()
     except FileNotFoundError:
         return None
-    return md5.hexdigest()
 
 
-def print_line(md5, file_path):
+def calculate_hashes(files, algo='md5'):
+    """
+    Calculate the hashes of several files concurrently.
+
+    @param files: list of paths to the files
+    @param algo: hash algorithm to use instead of md5, see new_hash
+    @return list of hex digests in the same order as files, with None for
+        each unsuccessful file
     """
-    Print a line of an md5 in the format of linux md5 files.
+    seen = {}
+    with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as executor:
+        return list(executor.map(
+            lambda f: calculate_hash(f, algo, seen), files))
+
+
+def check_md5_backend():
+    """Warn if hashlib is not backed by OpenSSL's optimized md5."""
+    if hashlib.md5.__module__ != '_hashlib':
+        eprint('WARNING: hashlib is not using OpenSSL, md5 will be slower')
 
-    @param md5: string of the md5sum for the file
+
+def format_line(file_hash, file_path):
+    """
+    Format a line of a hash in the format of linux md5 files.
+
+    @param file_hash: string of the hash for the file
     @param file_path: path to the file as it was input to the script
+    @return the line, including its trailing newline
     """
-    print('{}  {}'.format(md5, file_path))
+    return file_hash + '  ' + file_path + '\n'
 
 
 def add_files_recursive(targets, root_dir):
@@ -79,39 +275,56 @@ def add_files_recursive(targets, root_dir):
     @param targets: list of target files to add to
     @param root_dir: directory to begin recursive search
     """
-    for path, directories, files in os.walk(root_dir):
-        for f in files:
-            targets.append(os.path.join(path, f))
-
-
-def process_md5_line(line, targets):
+    directories = [root_dir]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            continue  # Unreadable directories are skipped, as os.walk does
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif not entry.is_dir():  # Don't list links to directories
+                    targets.append(entry.path)
+
+        # Visit subdirectories in listed order, like os.walk
+        directories.extend(reversed(subdirectories))
+
+
+def process_md5_line(line, hashes, paths, algo='md5'):
     """
-    Add a line from the md5 file to targets.
+    Add a line from the md5 file to the expected hashes and paths.
 
     @param line: the line from the md5 file
-    @targets: list of targets from the md5 file
+    @param hashes: list of expected hashes from the md5 file
+    @param paths: list of target paths from the md5 file, parallel to hashes
+    @param algo: hash algorithm the md5 file was made with, see new_hash
     @return 0 if successful, 1 otherwise
     """
-    md5_hash = line[:32].lower()
-    target = line[34:]  # Skip two space characters
-
-    if len(md5_hash) != 32:
-        print('Len {}'.format(len(md5_hash)))
+    length = HASH_LENGTHS[algo]
+    if len(line) < length:
         eprint('invalid hash length in line: {}'.format(line))
         return 1
-    for c in md5_hash:
-        if c not in HASH_CHARS:
-            eprint('invalid hash: {}'.format(line))
-            return 1
-    if len(target) <= 0:
+    # Validate in place before copying anything out of the line
+    if not HASH_RE[algo].fullmatch(line, 0, length):
+        eprint('invalid hash: {}'.format(line))
+        return 1
+
+    md5_hash = line[:length].lower()
+    separator = line[length:length + 2]  # Two spaces, or ' *' for binary
+    target = line[length + 2:]
+    if separator not in ('  ', ' *') or len(target) <= 0:
         eprint('invalid line: {}'.format(line))
         return 1
 
-    targets.append((md5_hash, target))
+    hashes.append(md5_hash)
+    paths.append(target)
     return 0
 
 
-def check_md5(md5_file):
+def check_md5(md5_file, algo='md5'):
     """
     Verify all of the file hashes.
 
@@ -119,37 +332,50 @@ def check_md5(md5_file):
     <hash>  <file>
     <hash>  <file>
     ...
+    @param algo: hash algorithm the md5 file was made with, see new_hash
     """
-    # Get utf encoding of hash file
-    encoding = get_encoding(md5_file)
-
     # Load all files and their hashes
-    targets = []
+    line_re = LINE_RE[algo]
+    hashes = []
+    paths = []
     n_bad = 0  # Number of invalid options for hashes
-    with open(md5_file, 'r', encoding=encoding) as input_file:
+    with open(md5_file, 'rb', buffering=CHUNK_SIZE) as raw_file:
 
-        # Strip BOM if there is one on the first line
-        line = input_file.readline()
+        # Get utf encoding of hash file and decode it from the same handle
+        encoding = get_encoding(raw_file)
+        input_file = io.TextIOWrapper(raw_file, encoding=encoding)
         if encoding is not None:
             eprint('Hash file encoding {}'.format(encoding))
-            line = line[1:]
 
-        while line:
+        for i, line in enumerate(input_file):
+            # Strip BOM if there is one on the first line
+            if i == 0 and encoding is not None:
+                line = line[1:]
+
+            # Well formed lines are split in one pass without stripping
+            match = line_re.fullmatch(line)
+            if match is not None:
+                hashes.append(match[1].lower())
+                paths.append(match[2])
+                continue
+
             line = line.strip()
             if len(line) <= 0:
                 continue
 
-            n_bad += process_md5_line(line, targets)
-            line = input_file.readline()
+            n_bad += process_md5_line(line, hashes, paths, algo)
 
     # Calculate hashes
-    for target in targets:
-        target_hash = calculate_md5sum(target[1])
-        if target_hash is not None and target_hash == target[0]:
-            print('{}: OK'.format(target[1]))
+    results = []
+    target_hashes = calculate_hashes(paths, algo)
+    for expected_hash, path, target_hash in zip(hashes, paths, target_hashes):
+        if target_hash is not None and target_hash == expected_hash:
+            results.append(path + ': OK\n')
         else:
-            print('{}: FAIL'.format(target[1]))
+            results.append(path + ': FAIL\n')
             n_bad += 1
+    sys.stdout.write(''.join(results))
+    sys.stdout.flush()  # Keep results ahead of the summary on stderr
 
     # Print final feedback and get correct exit code
     if n_bad > 0:
@@ -157,15 +383,56 @@ def check_md5(md5_file):
         sys.exit(1)
 
 
+def expand_files(patterns, recursive):
+    """
+    Create the list of files to hash from the command line patterns.
+
+    @param patterns: list of file paths or glob patterns
+    @param recursive: whether to recurse into directories
+    @return list of file paths of which to create md5sum hashes
+    """
+    # If there are globs, we perform glob expansion here
+    files = []
+    for f in patterns:
+
+        # Only pay for glob when the pattern has wildcards
+        globs = glob.glob(f) if GLOB_RE.search(f) else [f]
+        if len(globs) == 0:
+            files.append(f)  # Let this propogate to be handled later
+
+        for file_path in globs:
+
+            # Skip invalid captures from glob
+            if file_path in INVALID_FILES:
+                continue
+
+            # Recurse into directories if recursive. Otherwise, skip
+            if os.path.isdir(file_path):
+                if recursive:
+                    add_files_recursive(files, file_path)
+            else:
+                files.append(file_path)
+    return files
+
+
 def parse_args():
     """
     Parse command line args.
 
     If -h or --help is used, this will exit early. Otherwise,
     this creates a list of files of which to calculate the md5sum.
-    @return list of file paths of which to create md5sum hashes
+    @return tuple of the list of file paths of which to create md5sum
+        hashes and the hash algorithm to use
     """
-    # First parse arguments
+    # Plain lists of files need no option parsing
+    argv = sys.argv[1:]
+    if argv and not any(arg.startswith('-') for arg in argv):
+        check_md5_backend()
+        return expand_files(argv, False), 'md5'
+
+    # Otherwise parse arguments. argparse is slow to import, so it is
+    # only loaded when needed
+    import argparse
     parser = argparse.ArgumentParser(
         'Calculates md5sum hashes for input files.')
     parser.add_argument('files',
@@ -175,55 +442,47 @@ def parse_args():
                         default=False, help='recurse into directories')
     parser.add_argument('-c', dest='check', type=str, default=None,
                         help='check the hashes using an md5 file')
+    parser.add_argument('-a', '--algo', choices=sorted(HASH_LENGTHS),
+                        default='md5',
+                        help='hash algorithm, blake3 and xxh128 are faster '
+                             'but need the blake3 or xxhash package')
     args = parser.parse_args()
 
+    # Fail early if the package for the algorithm is missing
+    try:
+        new_hash(args.algo)
+    except ImportError as e:
+        eprint('ERROR: {} requires the {} package'.format(args.algo, e.name))
+        sys.exit(1)
+    if args.algo == 'md5':
+        check_md5_backend()
+
     # If used with check arg, check and then exit
     if args.check is not None:
-        check_md5(args.check)
+        check_md5(args.check, args.algo)
         exit()
 
-    # Now create list of files. If there are globs, we perform
-    # glob expansion here
-    files = []
-    for f in args.files:
-
-        globs = glob.glob(f)
-        if len(globs) == 0:
-            files.append(f)  # Let this propogate to be handled later
-
-        for file_path in globs:
-
-            # Skip invalid captures from glob
-            if file_path in INVALID_FILES:
-                continue
-
-            # Recurse into directories if recursive. Otherwise, skip
-            if os.path.isdir(file_path):
-                if args.recursive:
-                    add_files_recursive(files, file_path)
-            else:
-                files.append(file_path)
-    return files
+    return expand_files(args.files, args.recursive), args.algo
 
 
 def main():
     """Follow main flow."""
     # Determine targets
-    files = parse_args()
+    files, algo = parse_args()
 
     # Calculate hashes
     errors = []
-    md5s = []  # Tuples of (hash, file) for successful hashes
-    for f in files:
-        md5 = calculate_md5sum(f)
-        if md5 is None:
+    results = []  # Tuples of (hash, file) for successful hashes
+    for f, file_hash in zip(files, calculate_hashes(files, algo)):
+        if file_hash is None:
             errors.append(f)
             continue
-        md5s.append((md5, f))
+        results.append((file_hash, f))
 
     # Print hashes
-    for calculation in md5s:
-        print_line(calculation[0], calculation[1])
+    sys.stdout.write(''.join(format_line(file_hash, f)
+                             for file_hash, f in results))
+    sys.stdout.flush()  # Keep hashes ahead of any errors on stderr
 
     # Calculate errors
     if len(errors) > 0:
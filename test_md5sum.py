@@ -0,0 +1,222 @@
+"""Check that every way md5sum.py reads a file gives the same hash."""
+import hashlib
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+import md5sum
+
+CHUNK_SIZE = 1024
+MMAP_SIZE = 8 * CHUNK_SIZE
+
+
+@pytest.fixture(autouse=True)
+def small_sizes(monkeypatch):
+    """Shrink the size thresholds so each path runs on small files."""
+    monkeypatch.setattr(md5sum, 'CHUNK_SIZE', CHUNK_SIZE)
+    monkeypatch.setattr(md5sum, 'MMAP_SIZE', MMAP_SIZE)
+
+
+def write_file(tmp_path, size):
+    """Write a file of random bytes and return its path and md5."""
+    data = os.urandom(size)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    return str(path), hashlib.md5(data).hexdigest()
+
+
+@pytest.mark.parametrize('size', [0, CHUNK_SIZE - 1])
+def test_small_file(tmp_path, size):
+    path, expected = write_file(tmp_path, size)
+    assert md5sum.calculate_hash(path) == expected
+
+
+def test_file_digest(tmp_path):
+    path, expected = write_file(tmp_path, 3 * CHUNK_SIZE + 7)
+    assert md5sum.calculate_hash(path) == expected
+
+
+def test_read_chunks(tmp_path, monkeypatch):
+    monkeypatch.delattr(hashlib, 'file_digest', raising=False)
+    path, expected = write_file(tmp_path, 3 * CHUNK_SIZE + 7)
+    assert md5sum.calculate_hash(path) == expected
+
+
+def test_mmap(tmp_path):
+    path, expected = write_file(tmp_path, MMAP_SIZE + 7)
+    assert md5sum.calculate_hash(path) == expected
+
+
+def test_read_ahead_on_32_bit(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'maxsize', 2**31 - 1)
+    path, expected = write_file(tmp_path, 20 * CHUNK_SIZE + 7)
+    assert md5sum.calculate_hash(path) == expected
+
+
+def test_read_ahead_when_mmap_fails(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError('not mappable')
+
+    monkeypatch.setattr(md5sum.mmap, 'mmap', fail)
+    path, expected = write_file(tmp_path, 20 * CHUNK_SIZE + 7)
+    assert md5sum.calculate_hash(path) == expected
+
+
+class BoundedFile(io.FileIO):
+    """File that fails on reads without a size limit."""
+
+    def read(self, size=-1):
+        assert size is not None and size >= 0, 'unbounded read'
+        return super().read(size)
+
+
+def write_fifo(tmp_path, data):
+    """Create a fifo, write data to it in the background, return its path."""
+    path = str(tmp_path / 'data.fifo')
+    os.mkfifo(path)
+
+    def writer():
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    threading.Thread(target=writer, daemon=True).start()
+    return path
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs fifos')
+def test_pipe_is_streamed(tmp_path, monkeypatch):
+    monkeypatch.setattr(md5sum, 'open', lambda path, *args, **kwargs:
+                        BoundedFile(path, 'rb'), raising=False)
+    data = os.urandom(3 * CHUNK_SIZE + 7)
+    path = write_fifo(tmp_path, data)
+    assert os.stat(path).st_size == 0
+    assert md5sum.calculate_hash(path) == hashlib.md5(data).hexdigest()
+
+
+def test_read_ahead_raises_reader_errors():
+    class FailingFile(io.BytesIO):
+        calls = 0
+
+        def readinto(self, buffer):
+            self.calls += 1
+            if self.calls == 3:
+                raise ValueError('read failed')
+            return super().readinto(buffer)
+
+    with pytest.raises(ValueError):
+        for _ in md5sum.read_ahead(FailingFile(bytes(10 * CHUNK_SIZE))):
+            pass
+
+
+def test_read_ahead_stops_reader_on_early_exit():
+    threads = threading.active_count()
+    chunks = md5sum.read_ahead(io.BytesIO(bytes(20 * CHUNK_SIZE)))
+    next(chunks)
+    chunks.close()
+    assert threading.active_count() == threads
+
+
+def test_duplicate_paths(tmp_path):
+    path, expected = write_file(tmp_path, 3 * CHUNK_SIZE)
+    link = str(tmp_path / 'link.bin')
+    os.link(path, link)
+    missing = str(tmp_path / 'missing.bin')
+    assert md5sum.calculate_hashes([path, link, missing, path]) == [
+        expected, expected, None, expected]
+
+
+def write_manifest(tmp_path, monkeypatch, lines, encoding='ascii'):
+    """Write a.txt, b.txt and a manifest formatted with their hashes."""
+    monkeypatch.chdir(tmp_path)
+    hashes = {}
+    for name in ('a.txt', 'b.txt'):
+        data = name.encode() * 10
+        (tmp_path / name).write_bytes(data)
+        hashes[name] = hashlib.md5(data).hexdigest()
+    keys = {'a': hashes['a.txt'], 'b': hashes['b.txt'],
+            'A': hashes['a.txt'].upper()}
+    manifest = tmp_path / 'sums.md5'
+    manifest.write_text('\n'.join(lines).format(**keys), encoding=encoding)
+    return str(manifest)
+
+
+def test_check_separators_and_blank_lines(tmp_path, monkeypatch, capsys):
+    manifest = write_manifest(tmp_path, monkeypatch, [
+        '{a}  a.txt',
+        '',
+        '   ',
+        '  {b} *b.txt  ',
+    ])
+    md5sum.check_md5(manifest)
+    assert capsys.readouterr().out == 'a.txt: OK\nb.txt: OK\n'
+
+
+def test_check_uppercase_hash(tmp_path, monkeypatch, capsys):
+    manifest = write_manifest(tmp_path, monkeypatch, ['{A}  a.txt'])
+    md5sum.check_md5(manifest)
+    assert capsys.readouterr().out == 'a.txt: OK\n'
+
+
+@pytest.mark.parametrize('line', [
+    '{a}\ta.txt',  # Tab separator
+    '{a}XXa.txt',  # Unknown separator
+    '{a}0 a.txt',  # Hash too long
+    'zz{a}  a.txt',  # Not hex
+    '{a}  ',  # No path
+    'abc',  # Too short
+])
+def test_check_invalid_lines(tmp_path, monkeypatch, capsys, line):
+    manifest = write_manifest(tmp_path, monkeypatch, [line, '{b}  b.txt'])
+    with pytest.raises(SystemExit):
+        md5sum.check_md5(manifest)
+    out, err = capsys.readouterr()
+    assert out == 'b.txt: OK\n'
+    assert 'invalid' in err
+
+
+def test_check_wrong_hash(tmp_path, monkeypatch, capsys):
+    manifest = write_manifest(tmp_path, monkeypatch, ['{b}  a.txt'])
+    with pytest.raises(SystemExit):
+        md5sum.check_md5(manifest)
+    assert capsys.readouterr().out == 'a.txt: FAIL\n'
+
+
+@pytest.mark.parametrize('encoding', ['utf-8-sig', 'utf-16', 'utf-32'])
+def test_check_bom(tmp_path, monkeypatch, capsys, encoding):
+    manifest = write_manifest(tmp_path, monkeypatch,
+                              ['{a}  a.txt', '{b}  b.txt'], encoding)
+    md5sum.check_md5(manifest)
+    out, err = capsys.readouterr()
+    assert out == 'a.txt: OK\nb.txt: OK\n'
+    assert 'encoding' in err
+
+
+def test_add_files_recursive_matches_os_walk(tmp_path, monkeypatch):
+    for directory in ('a/b', 'a/c', 'd', 'locked'):
+        (tmp_path / directory).mkdir(parents=True)
+    for name in ('1.txt', 'a/2.txt', 'a/b/3.txt', 'a/c/4.txt', 'd/5.txt',
+                 'locked/6.txt'):
+        (tmp_path / name).write_text(name)
+    os.symlink(str(tmp_path / 'a'), str(tmp_path / 'd' / 'dir_link'))
+    os.symlink(str(tmp_path / '1.txt'), str(tmp_path / 'd' / 'file_link'))
+
+    # Pretend a directory can't be listed, for os.walk as well
+    scandir = os.scandir
+
+    def locked_scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', locked_scandir)
+
+    expected = [os.path.join(path, f)
+                for path, _, files in os.walk(str(tmp_path)) for f in files]
+    targets = []
+    md5sum.add_files_recursive(targets, str(tmp_path))
+    assert targets == expected
+    assert str(tmp_path / 'd' / 'file_link') in targets
+    assert not any('dir_link' in t or 'locked' in t for t in targets)